@@ -19,7 +19,7 @@ from __future__ import division
 from __future__ import print_function
 
 import heapq
-import math
+import itertools
 import numpy as np
 
 
@@ -40,66 +40,14 @@ class Caption(object):
         # score of the caption
         self.score = score
 
-    def __cmp__(self, other):
-        """Compares Captions by score"""
-
-        assert isinstance(other, Caption)
-        if self.score == other.score:
-            return 0
-        elif self.score < other.score:
-            return -1
-        else:
-            return 1
-
-    # for Python 3 compatibility (__cmp__ is deprecated).
+    # captions are ordered by score.
     def __lt__(self, other):
-        assert isinstance(other, Caption)
         return self.score < other.score
 
-    # also for Python 3 compatibility.
     def __eq__(self, other):
-        assert isinstance(other, Caption)
         return self.score == other.score
 
 
-class TopN(object):
-    """Maintains the top N elements of an incrementally provided set"""
-
-    def __init__(self, n):
-        self._n = n
-        self._data = []
-
-    def size(self):
-        assert self._data is not None
-        return len(self._data)
-
-    def push(self, x):
-        """Pushes a new element"""
-
-        assert self._data is not None
-        if len(self._data) < self._n:
-            heapq.heappush(self._data, x)
-        else:
-            heapq.heappushpop(self._data, x)
-
-    def extract(self, sort=False):
-        """
-            Extracts all elements from the TopN. This is a destructive operation,
-            The only method that can be called immediately after extract() is reset()
-        """
-        assert self._data is not None
-        data = self._data
-        self._data = None
-        if sort:
-            data.sort(reverse=True)
-        return data
-
-    def reset(self):
-        """Returns the TopN to an empty state"""
-
-        self._data = []
-
-
 class CaptionGenerator(object):
     """
         Class to generate captions from an image-to-text model
@@ -119,61 +67,77 @@ class CaptionGenerator(object):
         self.max_caption_length = max_caption_length
         self.length_normalization_factor = length_normalization_factor
 
-    def beam_search(self, sess, encoded_image):
-        """Runs beam search caption generation on a single image"""
+    def beam_search(self, sess, image=None, beam_size=None, max_caption_length=None, initial_state=None):
+        """
+            Runs beam search caption generation on a single encoded or decoded image, or from
+            the image's initial_state when it is already known. beam_size and max_caption_length
+            override the generator's defaults for this image
+        """
+        beam_size = beam_size or self.beam_size
+        max_caption_length = max_caption_length or self.max_caption_length
 
         # feed in the image to get the initial state.
-        initial_state = self.model.feed_image(sess, encoded_image)
-
-        initial_beam = Caption(
-            sentence=[self.vocab.start_id],
-            state=initial_state[0],
-            logprob=0.0,
-            score=0.0)
-        partial_captions = TopN(self.beam_size)
-        partial_captions.push(initial_beam)
-        complete_captions = TopN(self.beam_size)
+        if initial_state is None:
+            initial_state = self.model.feed_image(sess, image)
+
+        # partial captions are kept as parallel arrays with one row per beam, so
+        # the state feed for each step is a single gather from the last step.
+        sentences = [[self.vocab.start_id]]
+        states = initial_state
+        logprobs = np.zeros(1)
+        # complete captions are a bounded min-heap of (score, counter, caption);
+        # the counter breaks ties so captions themselves are never compared.
+        complete_captions = []
+        counter = itertools.count()
 
         # run beam search.
-        for _ in range(self.max_caption_length - 1):
-            partial_captions_list = partial_captions.extract()
-            partial_captions.reset()
-            input_feed = np.array([c.sentence[-1] for c in partial_captions_list])
-            state_feed = np.array([c.state for c in partial_captions_list])
-
-            softmax, new_states = self.model.inference_step(sess, input_feed, state_feed)
-
-            for i, partial_caption in enumerate(partial_captions_list):
-                word_probabilities = softmax[i]
-                state = new_states[i]
-                # for this partial caption, get the beam_size most probable next words.
-                words_and_probs = list(enumerate(word_probabilities))
-                words_and_probs.sort(key=lambda x: -x[1])
-                words_and_probs = words_and_probs[0:self.beam_size]
-                # each next word gives a new partial caption.
-                for w, p in words_and_probs:
-                    if p < 1e-12:
-                        continue  # avoid log(0).
-                    sentence = partial_caption.sentence + [w]
-                    logprob = partial_caption.logprob + math.log(p)
-                    score = logprob
-
-                    if w == self.vocab.end_id:
-                        if self.length_normalization_factor > 0:
-                            score /= len(sentence) ** self.length_normalization_factor
-                        beam = Caption(sentence, state, logprob, score)
-                        complete_captions.push(beam)
-                    else:
-                        beam = Caption(sentence, state, logprob, score)
-                        partial_captions.push(beam)
-            if partial_captions.size() == 0:
+        for _ in range(max_caption_length - 1):
+            # all the beams advance together in a single inference step.
+            input_feed = np.array([sentence[-1] for sentence in sentences], dtype=np.int64)
+
+            top_probabilities, top_words, new_states = self.model.top_words_step(
+                sess, input_feed, states, beam_size)
+
+            # each partial caption is continued with its beam_size most probable words,
+            # skipping the ones that would need log(0).
+            scores = logprobs[:, None] + np.log(np.maximum(top_probabilities, 1e-12))
+            valid = top_probabilities >= 1e-12
+            ended = top_words == self.vocab.end_id
+
+            # continuations with the end word are complete captions.
+            for b, j in zip(*np.nonzero(ended & valid)):
+                sentence = sentences[b] + [self.vocab.end_id]
+                logprob = float(scores[b, j])
+                score = logprob
+                if self.length_normalization_factor > 0:
+                    score /= len(sentence) ** self.length_normalization_factor
+                entry = (score, next(counter), Caption(sentence, new_states[b], logprob, score))
+                if len(complete_captions) < beam_size:
+                    heapq.heappush(complete_captions, entry)
+                else:
+                    heapq.heappushpop(complete_captions, entry)
+
+            # the beam_size best of the other continuations become the next partial
+            # captions, end words are excluded so they never take up a beam.
+            partial_scores = np.where(valid & ~ended, scores, -np.inf)
+            k = min(beam_size, partial_scores.size)
+            top = np.argpartition(partial_scores, -k, axis=None)[-k:]
+            top = top[np.isfinite(partial_scores.ravel()[top])]
+            if not len(top):
                 # we have run out of partial candidates; happens when beam_size = 1.
+                sentences = []
                 break
+            beams = top // scores.shape[1]
+            sentences = [sentences[b] + [w] for b, w in zip(beams.tolist(),
+                                                            top_words.ravel()[top].tolist())]
+            states = new_states[beams]
+            logprobs = scores.ravel()[top]
 
         # if we have no complete captions then fall back to the partial captions,
         # but never output a mixture of complete and partial captions because a
         # partial caption could have a higher score than all the complete captions
-        if not complete_captions.size():
-            complete_captions = partial_captions
+        if not complete_captions:
+            return [Caption(sentences[i], states[i], logprobs[i], logprobs[i])
+                    for i in np.argsort(-logprobs)[:len(sentences)]]
 
-        return complete_captions.extract(sort=True)
+        return [caption for _, _, caption in sorted(complete_captions, reverse=True)]
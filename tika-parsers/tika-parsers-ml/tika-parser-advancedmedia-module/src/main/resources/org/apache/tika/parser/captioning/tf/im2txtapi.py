@@ -28,6 +28,7 @@
       tensorflow
       numpy
       requests
+      PyTurboJPEG (optional)
 """
 
 from __future__ import absolute_import
@@ -37,8 +38,11 @@ from __future__ import print_function
 import json
 import logging
 import math
+import numpy as np
+import os
 import requests
 import sys
+import tempfile
 
 from flask import Flask, request, Response, jsonify
 from io import BytesIO
@@ -52,6 +56,13 @@ import model_wrapper
 import vocabulary
 import caption_generator
 
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    # decodes JPEGs with the SIMD libjpeg-turbo, when the library is installed
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
 # turning off the traceback by limiting its depth
 sys.tracebacklimit = 0
 
@@ -93,10 +104,24 @@ FLAGS = tf.flags.FLAGS
 tf.flags.DEFINE_string("checkpoint_path", checkpoint_path, """Directory containing the model checkpoint file.""")
 tf.flags.DEFINE_string('vocab_file', vocab_file, """Text file containing the vocabulary.""")
 tf.flags.DEFINE_integer('port', port, """Server PORT, default:8764""")
+tf.flags.DEFINE_integer('intra_op_threads', 0, """Number of threads used within an op, default:0 (number of cores)""")
+tf.flags.DEFINE_integer('inter_op_threads', 2, """Number of ops run in parallel, default:2""")
+tf.flags.DEFINE_integer('image_cache_size', 256, """Number of recent images whose Inception state is cached, default:256""")
+tf.flags.DEFINE_string('quantized_model', '',
+                       """Path to a quantized TFLite image model, created from the checkpoint if missing, default: float model""")
+tf.flags.DEFINE_string('calibration_dir', '', """Sample images to calibrate int8 activations, default: quantize weights only""")
+tf.flags.DEFINE_integer('num_calibration_images', 100, """Maximum number of calibration images, default:100""")
 
 tf.logging.set_verbosity(tf.logging.INFO)
 
 
+def session_config():
+    """Session options for serving"""
+
+    return tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                          inter_op_parallelism_threads=FLAGS.inter_op_threads)
+
+
 class Initializer(Flask):
     """
         Class to initialize the REST API, this class loads the model from the given checkpoint path in model_info.xml
@@ -108,16 +133,63 @@ class Initializer(Flask):
         # build the inference graph
         g = tf.Graph()
         with g.as_default():
-            model = model_wrapper.ModelWrapper()
+            model = model_wrapper.ModelWrapper(cache_size=FLAGS.image_cache_size)
             restore_fn = model.build_graph(FLAGS.checkpoint_path)
         g.finalize()
         # make the model globally available
         self.model = model
         # create the vocabulary
         self.vocab = vocabulary.Vocabulary(FLAGS.vocab_file)
+        # a single generator serves every request, beam_size and max_caption_length are given per request
+        self.generator = caption_generator.CaptionGenerator(model, self.vocab, beam_size=3, max_caption_length=20)
         self.sess = tf.Session(graph=g)
         # load the model from checkpoint
         restore_fn(self.sess)
+        self._freeze_graph()
+        if FLAGS.quantized_model:
+            if not os.path.exists(FLAGS.quantized_model):
+                tf.logging.info("Quantizing the image model into %s", FLAGS.quantized_model)
+                quantized_model = model.quantize(self.sess, calibration_images() if FLAGS.calibration_dir else None)
+                # move the model into place once fully written, a failure never leaves a partial model
+                fd, temp_path = tempfile.mkstemp(suffix='.tflite',
+                                                 dir=os.path.dirname(os.path.abspath(FLAGS.quantized_model)))
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(quantized_model)
+                    os.replace(temp_path, FLAGS.quantized_model)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+            model.load_quantized_model(FLAGS.quantized_model)
+
+    def _freeze_graph(self):
+        """
+            Folds the restored variables into constants and replaces the session
+            with one that runs the resulting frozen graph
+        """
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self.sess, self.sess.graph.as_graph_def(), ["images", "lstm/initial_state", "top_words", "lstm/state"])
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        graph.finalize()
+        self.model.resolve_tensors(graph)
+        self.sess.close()
+        self.sess = tf.Session(graph=graph, config=session_config())
+
+
+def calibration_images():
+    """Yields the sample images used to calibrate int8 activations, decoded to RGB arrays"""
+
+    file_names = sorted(os.listdir(FLAGS.calibration_dir))[:FLAGS.num_calibration_images]
+    for file_name in file_names:
+        try:
+            with Image.open(os.path.join(FLAGS.calibration_dir, file_name)) as image:
+                rgb_image = np.asarray(image.convert("RGB"))
+        except IOError:
+            tf.logging.warning("Skipping %s, it is not an image", file_name)
+            continue
+        yield rgb_image
 
 
 def current_time():
@@ -158,6 +230,9 @@ def index():
             <li> <code>/inception/v3/ping </code> - <br/>
                 <b> Description : </b> checks availability of the service. returns "pong" with status 200 when it is available
             </li>
+            <li> <code>/inception/v3/stats </code> - <br/>
+                <b> Description : </b> returns the hits, misses and size of the cache of recently captioned images
+            </li>
             <li> <code>/inception/v3/caption/image</code> - <br/>
                 <table>
                 <tr><th align="left"> Description </th><td> This is a service that can caption images</td></tr>
@@ -184,6 +259,13 @@ def ping_pong():
     return "pong"
 
 
+@app.route("/inception/v3/stats", methods=["GET"])
+def stats():
+    """API to report image cache statistics"""
+
+    return jsonify(app.model.cache_stats())
+
+
 @app.route("/inception/v3/caption/image", methods=["GET", "POST"])
 def caption_image():
     """API to caption images"""
@@ -205,31 +287,36 @@ def caption_image():
         if 'image/jpeg' in c_type:
             image_format = "jpeg"
 
-    # use c_type to find whether image_format is jpeg or not
-    # if jpeg, don't convert
-    if image_format == "jpeg":
-        jpg_image = image_data
-    # if not jpeg
+    # images captioned recently are served from the cache, without decoding them again
+    if app.model.cache_size > 0:
+        image_key = app.model.image_key(image_data)
+        initial_state = app.model.cached_initial_state(image_key)
     else:
-        # open the image from raw bytes
-        image = Image.open(BytesIO(image_data))
-        # convert the image to RGB format, otherwise will give errors when converting to jpeg, if the image isn't RGB
-        rgb_image = image.convert("RGB")
-        # convert the RGB image to jpeg
-        image_bytes = BytesIO()
-        rgb_image.save(image_bytes, format="jpeg", quality=95)
-        jpg_image = image_bytes.getvalue()
-        image_bytes.close()
+        image_key = initial_state = None
+    if initial_state is None:
+        # use c_type to find whether image_format is jpeg or not
+        # if jpeg, don't convert
+        if image_format == "jpeg":
+            if turbo_jpeg is not None:
+                # decode here, the graph then skips its own decoding
+                image = turbo_jpeg.decode(image_data, pixel_format=TJPF_RGB)
+            else:
+                image = image_data
+        # if not jpeg
+        else:
+            # decode with PIL and feed the RGB pixels directly, without re-encoding them to jpeg
+            image = np.asarray(Image.open(BytesIO(image_data)).convert("RGB"))
 
     read_time = current_time() - st
     # restart counter
     st = current_time()
 
-    generator = caption_generator.CaptionGenerator(app.model,
-                                                   app.vocab,
-                                                   beam_size=beam_size,
-                                                   max_caption_length=max_caption_length)
-    captions = generator.beam_search(app.sess, jpg_image)
+    if initial_state is None:
+        initial_state = app.model.feed_image(app.sess, image, image_key)
+    captions = app.generator.beam_search(app.sess,
+                                         beam_size=beam_size,
+                                         max_caption_length=max_caption_length,
+                                         initial_state=initial_state)
 
     captioning_time = current_time() - st
     app.logger.info("Captioning time : %d" % captioning_time)
@@ -19,21 +19,71 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import hashlib
 import os.path
+import threading
+from collections import OrderedDict
 
+import numpy as np
 import tensorflow as tf
 from tensorflow.contrib.slim.python.slim.nets.inception_v3 import inception_v3_base
 
 slim = tf.contrib.slim
 
 
+def _bilinear_weights(output_indices, input_size, output_size):
+    """
+        Source pixels and weights of a bilinear resize along one axis, sampled like TF1's
+        resize_images: align_corners=False and no half pixel centers
+    """
+    positions = output_indices.astype(np.float32) * np.float32(input_size / output_size)
+    lower = np.floor(positions).astype(np.intp)
+    upper = np.minimum(lower + 1, input_size - 1)
+    return lower, upper, (positions - lower).astype(np.float32)
+
+
+def preprocess_image(image, height=299, width=299, resize_height=346, resize_width=346):
+    """
+        Numpy equivalent of ShowAndTellModel.process_image for a decoded uint8 RGB array,
+        resizes, crops the center and rescales to [-1, 1]. The resize samples exactly as the
+        graph does and only computes the pixels within the central crop
+    """
+    # central crop, assuming resize_height > height, resize_width > width
+    top = (resize_height - height) // 2
+    left = (resize_width - width) // 2
+
+    # interpolate in float32 as the graph does, first the rows then the columns
+    y0, y1, dy = _bilinear_weights(np.arange(top, top + height), image.shape[0], resize_height)
+    x0, x1, dx = _bilinear_weights(np.arange(left, left + width), image.shape[1], resize_width)
+    image = image.astype(np.float32)
+    rows = image[y0] + (image[y1] - image[y0]) * dy[:, None, None]
+    processed = rows[:, x0] + (rows[:, x1] - rows[:, x0]) * dx[None, :, None]
+
+    # rescale to [-1, 1] instead of [0, 255]
+    processed *= np.float32(2.0 / 255.0)
+    processed -= 1.0
+    return processed
+
+
 class ModelWrapper(object):
     """
         Model wrapper class to perform image captioning with a ShowAndTellModel
     """
 
-    def __init__(self):
+    def __init__(self, cache_size=256):
         super(ModelWrapper, self).__init__()
+        # quantized TFLite image model, used by feed_image instead of the session when loaded
+        self.interpreter = None
+        self.interpreter_lock = threading.Lock()
+        # initial LSTM states of the most recently captioned images, keyed by image digest
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # session callables, keyed by session, fetches and feeds
+        self.callables = {}
+        self.callables_lock = threading.Lock()
 
     def build_graph(self, checkpoint_path):
         """Builds the inference graph"""
@@ -41,9 +91,26 @@ class ModelWrapper(object):
         tf.logging.info("Building model.")
         ShowAndTellModel().build()
         saver = tf.train.Saver()
+        self.resolve_tensors(tf.get_default_graph())
 
         return self._create_restore_fn(checkpoint_path, saver)
 
+    def resolve_tensors(self, graph):
+        """Looks up the feed and fetch tensors once, instead of by name on every run"""
+
+        with self.callables_lock:
+            self.callables = {}
+        self.image_feed = graph.get_tensor_by_name("image_feed:0")
+        self.image_array_feed = graph.get_tensor_by_name("image_array_feed:0")
+        self.images = graph.get_tensor_by_name("images:0")
+        self.initial_state = graph.get_tensor_by_name("lstm/initial_state:0")
+        self.input_feed = graph.get_tensor_by_name("input_feed:0")
+        self.state_feed = graph.get_tensor_by_name("lstm/state_feed:0")
+        self.state = graph.get_tensor_by_name("lstm/state:0")
+        self.num_top_words = graph.get_tensor_by_name("num_top_words:0")
+        self.top_probabilities = graph.get_tensor_by_name("top_words:0")
+        self.top_words = graph.get_tensor_by_name("top_words:1")
+
     def _create_restore_fn(self, checkpoint_path, saver):
         """Creates a function that restores a model from checkpoint file"""
 
@@ -60,19 +127,126 @@ class ModelWrapper(object):
 
         return _restore_fn
 
-    def feed_image(self, sess, encoded_image):
-        initial_state = sess.run(fetches="lstm/initial_state:0",
-                                 feed_dict={"image_feed:0": encoded_image})
-        return initial_state
+    def quantize(self, sess, calibration_images=None):
+        """
+            Converts the image model, from a preprocessed image to the initial LSTM state, into a
+            quantized TFLite model. Decoded RGB calibration_images are used to calibrate int8
+            activations, without them only the weights are quantized
+        """
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, sess.graph.as_graph_def(), ["lstm/initial_state"])
+        with tf.Graph().as_default() as graph:
+            images = tf.placeholder(tf.float32, shape=[1, 299, 299, 3], name="images")
+            initial_state, = tf.import_graph_def(graph_def,
+                                                 input_map={"images:0": images},
+                                                 return_elements=["lstm/initial_state:0"],
+                                                 name="")
+            with tf.Session(graph=graph) as quantize_sess:
+                converter = tf.lite.TFLiteConverter.from_session(quantize_sess, [images], [initial_state])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if calibration_images is not None:
+            def representative_dataset():
+                for image in calibration_images:
+                    yield [self._run(sess, self.images, (self.image_array_feed,), preprocess_image(image))]
+
+            converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        return converter.convert()
+
+    def load_quantized_model(self, model_path):
+        """Runs the image model with the quantized TFLite model at model_path from now on"""
+
+        interpreter = tf.lite.Interpreter(model_path=model_path)
+        interpreter.allocate_tensors()
+        self.interpreter = interpreter
+
+    @staticmethod
+    def image_key(encoded_image):
+        """Returns the cache key of an encoded image, the SHA-256 digest of its bytes"""
+
+        return hashlib.sha256(encoded_image).digest()
+
+    def cached_initial_state(self, key):
+        """Returns the cached initial LSTM state of the image with the given key, or None"""
+
+        if self.cache_size <= 0:
+            return None
+        with self.cache_lock:
+            initial_state = self.cache.get(key)
+            if initial_state is None:
+                self.cache_misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.cache_hits += 1
+            return initial_state.copy()
+
+    def feed_image(self, sess, image, key=None):
+        """
+            Runs the image model on either an encoded JPEG string or an already decoded
+            uint8 RGB array, returns the initial LSTM state. The state is cached under key,
+            the image_key of the encoded image the array was decoded from. Encoded images
+            are looked up in the cache by their own key
+        """
+        if key is None and self.cache_size > 0 and not isinstance(image, np.ndarray):
+            key = self.image_key(image)
+            initial_state = self.cached_initial_state(key)
+            if initial_state is not None:
+                return initial_state
+
+        initial_state = self._run_image_model(sess, image)
+        if key is not None and self.cache_size > 0:
+            with self.cache_lock:
+                self.cache[key] = initial_state
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return initial_state.copy()
+
+    def cache_stats(self):
+        """Returns the hits, misses and current size of the image cache"""
+
+        with self.cache_lock:
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'size': len(self.cache),
+                'max_size': self.cache_size
+            }
 
-    def inference_step(self, sess, input_feed, state_feed):
-        softmax_output, state_output = sess.run(
-            fetches=["softmax:0", "lstm/state:0"],
-            feed_dict={
-                "input_feed:0": input_feed,
-                "lstm/state_feed:0": state_feed,
-            })
-        return softmax_output, state_output
+    def _run_image_model(self, sess, image):
+        if isinstance(image, np.ndarray):
+            feed, image = self.image_array_feed, preprocess_image(image)
+        else:
+            feed = self.image_feed
+
+        if self.interpreter is not None:
+            # the session still decodes and preprocesses the image
+            images = self._run(sess, self.images, (feed,), image)
+            with self.interpreter_lock:
+                self.interpreter.set_tensor(self.interpreter.get_input_details()[0]['index'], images)
+                self.interpreter.invoke()
+                return self.interpreter.get_tensor(self.interpreter.get_output_details()[0]['index'])
+
+        return self._run(sess, self.initial_state, (feed,), image)
+
+    def top_words_step(self, sess, input_feed, state_feed, k):
+        """Runs a single LSTM step, fetching only the k most probable next words of each input and the new state"""
+
+        top_probabilities, top_words, state_output = self._run(
+            sess, (self.top_probabilities, self.top_words, self.state),
+            (self.input_feed, self.state_feed, self.num_top_words), input_feed, state_feed, k)
+        return top_probabilities, top_words, state_output
+
+    def _run(self, sess, fetches, feed_list, *feed_values):
+        """
+            Runs fetches with a callable made once per session, fetches and feed_list,
+            which skips the fetch and feed_dict parsing of sess.run on every step
+        """
+        key = (sess, fetches, feed_list)
+        with self.callables_lock:
+            run_fn = self.callables.get(key)
+            if run_fn is None:
+                run_fn = self.callables[key] = sess.make_callable(fetches, feed_list)
+        return run_fn(*feed_values)
 
 
 class ShowAndTellModel(object):
@@ -181,8 +355,12 @@ class ShowAndTellModel(object):
                                     shape=[None],  # batch_size
                                     name="input_feed")
 
-        # process image and insert batch dimensions
-        images = tf.expand_dims(self.process_image(image_feed), 0)
+        # process image and insert batch dimensions, images decoded and preprocessed
+        # outside of the graph with preprocess_image are fed in place of process_image
+        image = tf.placeholder_with_default(self.process_image(image_feed),
+                                            shape=[self.image_height, self.image_width, 3],
+                                            name="image_array_feed")
+        images = tf.expand_dims(image, 0, name="images")
         input_seqs = tf.expand_dims(input_feed, 1)
 
         # no target sequences or input mask in inference mode
@@ -319,7 +497,11 @@ class ShowAndTellModel(object):
                 weights_initializer=self.initializer,
                 scope=logits_scope)
 
-        tf.nn.softmax(logits, name="softmax")
+        softmax = tf.nn.softmax(logits, name="softmax")
+
+        # select the most probable next words within the graph, so only those are fetched
+        num_top_words = tf.placeholder(dtype=tf.int32, shape=[], name="num_top_words")
+        tf.nn.top_k(softmax, k=tf.minimum(num_top_words, self.vocab_size), name="top_words")
 
     def setup_global_step(self):
         """Sets up the global step Tensor"""
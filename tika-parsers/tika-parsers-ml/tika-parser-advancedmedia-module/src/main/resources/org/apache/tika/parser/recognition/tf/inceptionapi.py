@@ -22,12 +22,19 @@
     For more details, visit:
         https://tensorflow.org/tutorials/image_recognition/
 
+    Concurrent requests are classified together in batches, so the server has to handle
+    requests in parallel. When deploying behind a WSGI server, use a single threaded worker
+    to keep one copy of the model, e.g.
+        gunicorn -w 1 -k gthread --threads 32 -b 0.0.0.0:8764 inceptionapi:app
+
     Requirements :
+      Python 3
       Flask
       tensorflow
       numpy
       requests
       pillow
+      orjson (optional)
 """
 
 from __future__ import absolute_import
@@ -38,25 +45,36 @@ import os
 import tempfile
 import json
 import logging
+import numpy as np
 import requests
+import threading
+import queue
 
 from flask import Flask, request, Response, jsonify
 from io import BytesIO
+from itertools import islice
 from logging.handlers import RotatingFileHandler
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from time import time
 
 import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 from inception_v4 import default_image_size, inception_v4_arg_scope, inception_v4
 
 try:
     # This import is placed inside here to ensure that video_util and OpenCV is not required for image recognition APIs
-    from video_util import get_center_frame, get_frames_interval, get_n_frames
+    from video_util import get_center_frame, iter_frames_interval, iter_n_frames
 except:
     print("Can't import video libraries, No video functionality is available")
 
-json.encoder.FLOAT_REPR = lambda o: format(o, '.2f')  # JSON serialization of floats
+try:
+    # serializes responses considerably faster than the json module, when it is installed
+    import orjson
+except ImportError:
+    orjson = None
+
 slim = tf.contrib.slim
 FLAGS = tf.app.flags.FLAGS
 
@@ -69,6 +87,44 @@ tf.app.flags.DEFINE_integer('port',
 tf.app.flags.DEFINE_string('log',
                            'inception.log',
                            """Log file name, default: inception.log""")
+tf.app.flags.DEFINE_integer('max_download_size',
+                            50 * 1024 * 1024,
+                            """Maximum size in bytes of an image fetched from a url, default:50MiB""")
+tf.app.flags.DEFINE_integer('max_batch_size',
+                            32,
+                            """Maximum number of images classified in a single session run, default:32""")
+tf.app.flags.DEFINE_integer('batch_timeout_ms',
+                            10,
+                            """Maximum time to wait for a batch to fill up, default:10""")
+tf.app.flags.DEFINE_integer('intra_op_threads',
+                            0,
+                            """Number of threads used within an op, default:0 (number of cores)""")
+tf.app.flags.DEFINE_integer('inter_op_threads',
+                            2,
+                            """Number of ops run in parallel, default:2""")
+tf.app.flags.DEFINE_string('quantized_model',
+                           '',
+                           """Path to a quantized TFLite model, created from the checkpoint if missing, default: float model""")
+tf.app.flags.DEFINE_string('calibration_dir',
+                           '',
+                           """Sample images to calibrate int8 activations, default: quantize weights only""")
+tf.app.flags.DEFINE_integer('num_calibration_images',
+                            100,
+                            """Maximum number of calibration images, default:100""")
+
+# remote images are fetched over pooled keep-alive connections
+http_session = requests.Session()
+http_session.mount('http://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+http_session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64))
+
+
+def session_config():
+    """Session options for serving, with grappler memory optimizations turned on"""
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                            inter_op_parallelism_threads=FLAGS.inter_op_threads)
+    config.graph_options.rewrite_options.memory_optimization = rewriter_config_pb2.RewriterConfig.HEURISTICS
+    return config
 
 
 def preprocess_image(image, height, width, central_fraction=0.875, scope=None):
@@ -133,21 +189,23 @@ def create_readable_names_for_imagenet_labels():
 
     dest_directory = FLAGS.model_dir
 
-    synset_list = [s.strip() for s in open(os.path.join(dest_directory, 'imagenet_lsvrc_2015_synsets.txt')).readlines()]
+    with open(os.path.join(dest_directory, 'imagenet_lsvrc_2015_synsets.txt')) as f:
+        synset_list = [s.strip() for s in f]
     num_synsets_in_ilsvrc = len(synset_list)
     assert num_synsets_in_ilsvrc == 1000
 
-    synset_to_human_list = open(os.path.join(dest_directory, 'imagenet_metadata.txt')).readlines()
-    num_synsets_in_all_imagenet = len(synset_to_human_list)
-    assert num_synsets_in_all_imagenet == 21842
-
+    # only keep the names of the ILSVRC synsets, out of all the synsets in Imagenet
+    wanted_synsets = frozenset(synset_list)
     synset_to_human = {}
-    for s in synset_to_human_list:
-        parts = s.strip().split('\t')
-        assert len(parts) == 2
-        synset = parts[0]
-        human = parts[1]
-        synset_to_human[synset] = human
+    num_synsets_in_all_imagenet = 0
+    with open(os.path.join(dest_directory, 'imagenet_metadata.txt')) as f:
+        for s in f:
+            num_synsets_in_all_imagenet += 1
+            synset, sep, human = s.partition('\t')
+            assert sep
+            if synset in wanted_synsets:
+                synset_to_human[synset] = human.strip()
+    assert num_synsets_in_all_imagenet == 21842
 
     label_index = 1
     labels_to_names = {0: 'background'}
@@ -166,15 +224,78 @@ def get_remote_file(url, success=200, timeout=10):
     """
     try:
         app.logger.info("GET: %s" % url)
-        auth = None
-        res = requests.get(url, stream=True, timeout=timeout, auth=auth)
-        if res.status_code == success:
-            return res.headers.get('Content-Type', 'application/octet-stream'), res.raw.data
+        with http_session.get(url, stream=True, timeout=timeout) as res:
+            if res.status_code == success:
+                content = bytearray()
+                for chunk in res.iter_content(chunk_size=64 * 1024):
+                    content.extend(chunk)
+                    if len(content) > FLAGS.max_download_size:
+                        app.logger.warning("%s is larger than %d bytes" % (url, FLAGS.max_download_size))
+                        return None, None
+                return res.headers.get('Content-Type', 'application/octet-stream'), bytes(content)
     except:
         pass
     return None, None
 
 
+def prefetch(iterable, size):
+    """
+        Iterates over the given iterable on a background thread, so that up to size
+        items are produced ahead of the consumer
+    """
+    buffer = queue.Queue(maxsize=size)
+    end = object()
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((end, None))
+        except Exception as e:
+            put((end, e))
+
+    producer = threading.Thread(target=produce, name="prefetch")
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        # lets the producer give up if the consumer stops early
+        stopped.set()
+
+
+def top_k(probabilities, k):
+    """Numpy counterpart of tf.nn.top_k, returns the k highest scores in each row and their indices, best first"""
+
+    top_indices = np.argsort(-probabilities, axis=1)[:, :k]
+    return np.take_along_axis(probabilities, top_indices, axis=1), top_indices
+
+
+def to_json(obj):
+    """Serializes the given object into JSON, using orjson when it is available"""
+
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=lambda o: o.tolist())
+
+
 def current_time():
     """Returns current time in milli seconds"""
 
@@ -191,16 +312,21 @@ class Classifier(Flask):
         formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
         file_handler.setFormatter(formatter)
         self.logger.addHandler(file_handler)
-        self.names = create_readable_names_for_imagenet_labels()
+        # class ids are dense, so their names are looked up by position
+        names = create_readable_names_for_imagenet_labels()
+        self.names = tuple(names[i] for i in range(len(names)))
         self.image_size = default_image_size
-
-        self.image_str_placeholder = tf.placeholder(tf.string)
-        image = tf.image.decode_jpeg(self.image_str_placeholder, channels=3)
-        processed_image = preprocess_image(image, self.image_size, self.image_size)
-        processed_images = tf.expand_dims(processed_image, 0)
+        self.num_classes = 1001
+
+        # a batch of encoded images, each one is decoded and preprocessed independently
+        self.image_str_placeholder = tf.placeholder(tf.string, shape=[None])
+        processed_images = tf.map_fn(self._decode_and_preprocess, self.image_str_placeholder,
+                                     dtype=tf.float32, back_prop=False)
+        processed_images.set_shape([None, self.image_size, self.image_size, 3])
+        self.images = processed_images
         # create the model, use the default arg scope to configure the batch norm parameters.
         with slim.arg_scope(inception_v4_arg_scope()):
-            logits, _ = inception_v4(processed_images, num_classes=1001, is_training=False)
+            logits, _ = inception_v4(self.images, num_classes=self.num_classes, is_training=False)
         self.probabilities = tf.nn.softmax(logits)
 
         dest_directory = FLAGS.model_dir
@@ -208,30 +334,245 @@ class Classifier(Flask):
             os.path.join(dest_directory, 'inception_v4.ckpt'),
             slim.get_model_variables('InceptionV4'))
 
-        self.sess = tf.Session()
+        self.sess = tf.Session(config=session_config())
         init_fn(self.sess)
+        self._freeze_graph()
+
+        # images decoded outside of tensorflow are fed as RGB arrays, skipping decoding
+        with self.sess.graph.as_default():
+            self.rgb_placeholder = tf.placeholder(tf.uint8, shape=[None, None, 3])
+            rgb_images = tf.expand_dims(preprocess_image(self.rgb_placeholder, self.image_size, self.image_size), 0)
+        self._preprocess_rgb_fn = self.sess.make_callable(rgb_images, [self.rgb_placeholder])
+
+        if FLAGS.quantized_model:
+            preprocess = self.sess.make_callable(self.images, [self.image_str_placeholder])
+            run_images = self._quantized_model_fn(FLAGS.quantized_model, preprocess)
+            self._run_fn = lambda image_strings: run_images(preprocess(image_strings))
+            self._top_k_fn = lambda image_strings, k: top_k(self._run_fn(image_strings), k)
+            self._top_k_images_fn = lambda images, k: top_k(run_images(images), k)
+        else:
+            self._run_fn = self.sess.make_callable(self.probabilities, [self.image_str_placeholder])
+            # select the top classes within the graph, so only those are fetched
+            with self.sess.graph.as_default():
+                self.topn_placeholder = tf.placeholder(tf.int32, shape=[])
+                top_scores, top_indices = tf.nn.top_k(self.probabilities, k=self.topn_placeholder)
+            self._top_k_fn = self.sess.make_callable([top_scores, top_indices],
+                                                     [self.image_str_placeholder, self.topn_placeholder])
+            self._top_k_images_fn = self.sess.make_callable([top_scores, top_indices],
+                                                            [self.images, self.topn_placeholder])
+
+        # concurrent classify requests are queued up and run together as one batch
+        self.pending = queue.Queue()
+        batch_thread = threading.Thread(target=self._run_batches, name="classifier-batcher")
+        batch_thread.daemon = True
+        batch_thread.start()
+
+    def _freeze_graph(self):
+        """
+            Folds the restored variables into constants and replaces the session
+            with one that runs the resulting frozen graph
+        """
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            self.sess, self.sess.graph.as_graph_def(), [self.probabilities.op.name])
+        graph = tf.Graph()
+        with graph.as_default():
+            self.image_str_placeholder, self.images, self.probabilities = tf.import_graph_def(
+                graph_def,
+                return_elements=[self.image_str_placeholder.name, self.images.name, self.probabilities.name],
+                name="")
+        self.sess.close()
+        self.sess = tf.Session(graph=graph, config=session_config())
+
+    def _quantize(self, preprocess):
+        """
+            Converts the inception network of the frozen graph into a quantized TFLite model,
+            from preprocessed images to class probabilities
+        """
+        with tf.Graph().as_default() as graph:
+            images = tf.placeholder(tf.float32, shape=[1, self.image_size, self.image_size, 3], name="images")
+            probabilities, = tf.import_graph_def(self.sess.graph.as_graph_def(),
+                                                 input_map={self.images.name: images},
+                                                 return_elements=[self.probabilities.name],
+                                                 name="")
+            with tf.Session(graph=graph) as sess:
+                converter = tf.lite.TFLiteConverter.from_session(sess, [images], [probabilities])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if FLAGS.calibration_dir:
+            def calibration_images():
+                file_names = sorted(os.listdir(FLAGS.calibration_dir))[:FLAGS.num_calibration_images]
+                for file_name in file_names:
+                    with open(os.path.join(FLAGS.calibration_dir, file_name), 'rb') as f:
+                        image_string = f.read()
+                    try:
+                        images = preprocess([image_string])
+                    except tf.errors.InvalidArgumentError:
+                        self.logger.warning("Skipping calibration file %s, it is not an image" % file_name)
+                        continue
+                    yield [images]
+
+            # calibrate activation ranges too, so that all the kernels run on int8
+            converter.representative_dataset = tf.lite.RepresentativeDataset(calibration_images)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        return converter.convert()
+
+    def _quantized_model_fn(self, model_path, preprocess):
+        """
+            Returns a function that classifies a batch of preprocessed images with the quantized
+            TFLite model at model_path, converting the model first if it doesn't exist yet.
+            Images are still decoded and preprocessed by the tensorflow session.
+        """
+        if not os.path.exists(model_path):
+            self.logger.info("Quantizing inception into %s" % model_path)
+            model = self._quantize(preprocess)
+            # move the model into place once fully written, a failure never leaves a partial model
+            fd, temp_path = tempfile.mkstemp(suffix='.tflite', dir=os.path.dirname(os.path.abspath(model_path)))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(model)
+                os.replace(temp_path, model_path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+
+        interpreter = tf.lite.Interpreter(model_path=model_path)
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        # the interpreter is not thread safe and its input is resized to fit each batch
+        lock = threading.Lock()
+        input_shape = []
+
+        def run(images):
+            with lock:
+                if list(images.shape) != input_shape:
+                    interpreter.resize_tensor_input(input_index, images.shape)
+                    interpreter.allocate_tensors()
+                    input_shape[:] = images.shape
+                interpreter.set_tensor(input_index, images)
+                interpreter.invoke()
+                return interpreter.get_tensor(output_index)
+
+        return run
+
+    def _decode_and_preprocess(self, image_str, central_fraction=0.875):
+        """Decodes a JPEG, PNG, GIF or BMP image string and prepares it for evaluation"""
+
+        def decode_and_crop_jpeg():
+            # crop while decoding, the blocks outside of the central region are never decoded
+            shape = tf.image.extract_jpeg_shape(image_str)[:2]
+            size = tf.cast(shape, tf.float64)
+            offset = tf.cast((size - size * central_fraction) / 2, tf.int32)
+            crop_window = tf.concat([offset, shape - offset * 2], axis=0)
+            return tf.image.decode_and_crop_jpeg(image_str, crop_window, channels=3)
+
+        def decode_and_crop():
+            image = tf.image.decode_image(image_str, channels=3, expand_animations=False)
+            image.set_shape([None, None, 3])
+            return tf.image.central_crop(image, central_fraction=central_fraction)
+
+        image = tf.cond(tf.image.is_jpeg(image_str), decode_and_crop_jpeg, decode_and_crop)
+        image.set_shape([None, None, 3])
+        return preprocess_image(image, self.image_size, self.image_size, central_fraction=None)
+
+    def _next_batch(self):
+        """
+            Blocks until a request is available, then collects more requests until
+            either the batch is full or the batch timeout expires
+        """
+        batch = [self.pending.get()]
+        deadline = time() + FLAGS.batch_timeout_ms / 1000.0
+        while len(batch) < FLAGS.max_batch_size:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batches(self):
+        """Batch worker loop, runs each batch of pending requests through the session"""
+
+        while True:
+            batch = self._next_batch()
+            # fetch enough classes for the request asking for the most of them
+            k = max(self.num_classes if topn is None else topn for _, topn, _, _ in batch)
+            k = max(0, min(k, self.num_classes))
+            try:
+                top_scores, top_indices = self._top_k_fn([b[0] for b in batch], k)
+                for i, (_, _, _, result) in enumerate(batch):
+                    result.append((top_scores[i], top_indices[i]))
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][3].append(e)
+                else:
+                    # one bad image fails the whole batch, so retry them one by one
+                    # in order to report the error only to the request that caused it
+                    for image_string, _, _, result in batch:
+                        try:
+                            top_scores, top_indices = self._top_k_fn([image_string], k)
+                            result.append((top_scores[0], top_indices[0]))
+                        except Exception as e:
+                            result.append(e)
+            for _, _, done, _ in batch:
+                done.set()
 
     def classify(self, image_string, topn, min_confidence):
-        eval_probabilities = self.sess.run(self.probabilities, feed_dict={self.image_str_placeholder: image_string})
-        eval_probabilities = eval_probabilities[0, 0:]
-        sorted_inds = [i[0] for i in sorted(enumerate(-eval_probabilities), key=lambda x: x[1])]
+        done = threading.Event()
+        result = []
+        self.pending.put((image_string, topn, done, result))
+        done.wait()
+        if isinstance(result[0], Exception):
+            raise result[0]
+        top_scores, top_indices = result[0]
+        # the batch may have fetched more classes than this request asked for
+        n = self.num_classes if topn is None else max(0, min(topn, self.num_classes))
+        return self._confident_classes(top_indices[:n], top_scores[:n], min_confidence)
+
+    def classify_rgb(self, image_array, topn, min_confidence):
+        """Classifies an image that is already decoded into a uint8 RGB array of shape [height, width, 3]"""
+
+        k = self.num_classes if topn is None else max(0, min(topn, self.num_classes))
+        top_scores, top_indices = self._top_k_images_fn(self._preprocess_rgb_fn(image_array), k)
+        return self._confident_classes(top_indices[0], top_scores[0], min_confidence)
+
+    def classify_frames(self, image_strings, topn, min_confidence):
+        """Classifies video frames by their class probabilities averaged over all frames"""
+
+        image_strings = iter(image_strings)
+        total_probabilities = 0
+        num_frames = 0
+        while True:
+            batch = list(islice(image_strings, FLAGS.max_batch_size))
+            if not batch:
+                break
+            eval_probabilities = self._run_fn(batch)
+            total_probabilities += eval_probabilities.sum(axis=0)
+            num_frames += len(batch)
+        if not num_frames:
+            raise ValueError("No frames could be extracted from the video")
+        return self._top_classes(total_probabilities / num_frames, topn, min_confidence)
+
+    def _top_classes(self, eval_probabilities, topn, min_confidence):
+        """Returns the ids, names and scores of the topn classes having at least min_confidence, best first"""
 
         if topn is None:
-            topn = len(sorted_inds)
-
-        res = []
-        for i in range(topn):
-            index = sorted_inds[i]
-            score = float(eval_probabilities[index])
-            if min_confidence is None:
-                res.append((index, self.names[index], score))
-            else:
-                if score >= min_confidence:
-                    res.append((index, self.names[index], score))
-                else:
-                    # the scores are in sorted order, so we can break the loop whenever we get a low score object
-                    break
-        return res
+            sorted_inds = np.argsort(-eval_probabilities)
+        else:
+            # only the top n classes are needed, so partition before sorting
+            k = max(0, min(topn, eval_probabilities.shape[0]))
+            top_inds = np.argpartition(-eval_probabilities, k - 1)[:k] if k else np.arange(0)
+            sorted_inds = top_inds[np.argsort(-eval_probabilities[top_inds])]
+        return self._confident_classes(sorted_inds, eval_probabilities[sorted_inds], min_confidence)
+
+    def _confident_classes(self, class_ids, scores, min_confidence):
+        """Returns the ids, names and scores of the given best first classes, without those below min_confidence"""
+
+        if min_confidence is not None:
+            # the scores are in sorted order, so the confident classes come first
+            num_confident = np.count_nonzero(scores >= min_confidence)
+            class_ids, scores = class_ids[:num_confident], scores[:num_confident]
+        return class_ids, [self.names[i] for i in class_ids.tolist()], scores
 
 
 app = Classifier(__name__)
@@ -312,8 +653,6 @@ def ping_pong():
 def classify_image():
     """API to classify images"""
 
-    image_format = "not jpeg"
-
     st = current_time()
     topn = int(request.args.get("topn", "5"))
     min_confidence = float(request.args.get("min_confidence", "0.015"))
@@ -325,33 +664,24 @@ def classify_image():
         c_type, image_data = get_remote_file(url)
         if not image_data:
             return Response(status=400, response=jsonify(error="Could not HTTP GET %s" % url))
-        if 'image/jpeg' in c_type:
-            image_format = "jpeg"
-
-    # use c_type to find whether image_format is jpeg or not
-    # if jpeg, don't convert
-    if image_format == "jpeg":
-        jpg_image = image_data
-    # if not jpeg
-    else:
-        # open the image from raw bytes
-        image = Image.open(BytesIO(image_data))
-        # convert the image to RGB format, otherwise will give errors when converting to jpeg, if the image isn't RGB
-        rgb_image = image.convert("RGB")
-        # convert the RGB image to jpeg
-        image_bytes = BytesIO()
-        rgb_image.save(image_bytes, format="jpeg", quality=95)
-        jpg_image = image_bytes.getvalue()
-        image_bytes.close()
 
     read_time = current_time() - st
     st = current_time()  # reset start time
     try:
-        classes = app.classify(image_string=jpg_image, topn=topn, min_confidence=min_confidence)
+        try:
+            # JPEG, PNG, GIF and BMP images are decoded within the graph
+            classids, classnames, confidence = app.classify(image_string=image_data, topn=topn,
+                                                            min_confidence=min_confidence)
+        except tf.errors.InvalidArgumentError:
+            # tensorflow can't decode other formats, so decode them with PIL instead
+            # convert the image to RGB format, as the classifier only accepts RGB images
+            image = np.asarray(Image.open(BytesIO(image_data)).convert("RGB"))
+            classids, classnames, confidence = app.classify_rgb(image, topn=topn, min_confidence=min_confidence)
     except Exception as e:
         app.logger.error(e)
         return Response(status=400, response=str(e))
-    classids, classnames, confidence = zip(*classes)
+    # confidence scores are reported at full precision
+    confidence = confidence.astype(np.float64)
 
     print(classnames, confidence)
 
@@ -368,7 +698,7 @@ def classify_image():
     }
     if human:
         res['classnames'] = classnames
-    return Response(response=json.dumps(res), status=200, mimetype="application/json")
+    return Response(response=to_json(res), status=200, mimetype="application/json")
 
 
 @app.route("/inception/v4/classify/video", methods=["GET", "POST"])
@@ -405,57 +735,43 @@ def classify_video():
     frame_interval = int(request.args.get("frame-interval", "10"))
     num_frame = int(request.args.get("num-frame", "10"))
 
+    temp_path = None
     if request.method == 'POST':
         video_data = request.get_data()
         ext = request.args.get("ext", ".mp4").lower()
 
-        temp_file = tempfile.NamedTemporaryFile(suffix=ext)
-        temp_file.file.write(video_data)
-        temp_file.file.close()
+        # OpenCV reads videos from a path, so the file is fully written and closed before it is opened again
+        fd, temp_path = tempfile.mkstemp(suffix=ext)
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(video_data)
 
-        url = temp_file.name
+        url = temp_path
     else:
         url = request.args.get("url")
 
     read_time = current_time() - st
     st = current_time()  # reset start time
 
-    if mode == "center":
-        image_data_arr = [get_center_frame(url)]
-    elif mode == "interval":
-        image_data_arr = get_frames_interval(url, frame_interval)
-    else:
-        image_data_arr = get_n_frames(url, num_frame)
-
-    classes = []
-    for image_data in image_data_arr:
-        try:
-            _classes = app.classify(image_data, topn=None, min_confidence=None)
-        except Exception as e:
-            app.logger.error(e)
-            return Response(status=400, response=str(e))
-
-        _classes.sort()
-        if len(classes) == 0:
-            classes = _classes
+    try:
+        # frames are extracted in the background while the previous batch is being classified
+        if mode == "center":
+            image_data_arr = [get_center_frame(url)]
+        elif mode == "interval":
+            image_data_arr = prefetch(iter_frames_interval(url, frame_interval), FLAGS.max_batch_size)
         else:
-            for idx, _c in enumerate(_classes):
-                c = list(classes[idx])
-                c[2] += _c[2]
-                classes[idx] = tuple(c)
-
-    top_classes = []
-    for c in classes:
-        c = list(c)
-        # avg out confidence score
-        avg_score = c[2] / len(image_data_arr)
-        c[2] = avg_score
-        if avg_score >= min_confidence:
-            top_classes.append(tuple(c))
+            image_data_arr = prefetch(iter_n_frames(url, num_frame), FLAGS.max_batch_size)
 
-    top_classes = sorted(top_classes, key=lambda tup: tup[2])[-topn:][::-1]
+        classids, classnames, confidence = app.classify_frames(image_data_arr, topn=topn,
+                                                               min_confidence=min_confidence)
+    except Exception as e:
+        app.logger.error(e)
+        return Response(status=400, response=str(e))
+    finally:
+        if temp_path:
+            os.remove(temp_path)
 
-    classids, classnames, confidence = zip(*top_classes)
+    # confidence scores are reported at full precision
+    confidence = confidence.astype(np.float64)
 
     classifier_time = current_time() - st
     app.logger.info("Classifier time : %d" % classifier_time)
@@ -470,13 +786,14 @@ def classify_video():
     }
     if human:
         res['classnames'] = classnames
-    return Response(response=json.dumps(res), status=200, mimetype="application/json")
+    return Response(response=to_json(res), status=200, mimetype="application/json")
 
 
 def main(_):
     if not app.debug:
         print("Serving on port %d" % FLAGS.port)
-    app.run(host="0.0.0.0", port=FLAGS.port)
+    # handle each request on its own thread, so that concurrent requests can be batched
+    app.run(host="0.0.0.0", port=FLAGS.port, threaded=True)
 
 
 if __name__ == '__main__':
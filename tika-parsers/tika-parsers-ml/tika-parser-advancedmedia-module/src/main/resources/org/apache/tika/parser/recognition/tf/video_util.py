@@ -31,7 +31,7 @@ else:
 def _get_image_from_array(image_array):
     # JPG to support tensorflow
     byte_arr = cv2.imencode(".jpg", image_array)[1]
-    return "".join(map(chr, byte_arr))
+    return byte_arr.tobytes()
 
 
 def _path_leaf(path):
@@ -61,9 +61,9 @@ def get_center_frame(video_path):
     return _get_image_from_array(image)
 
 
-def get_frames_interval(video_path, frame_interval):
+def iter_frames_interval(video_path, frame_interval):
     """
-    Selects one frames after every frame_interval
+    Yields one frame after every frame_interval, as the video is being decoded
     @param video_path: Path to video file on system
     @param frame_interval: Interval after which frame should be picked. If frame_interval=10 then every 10th frame will be extracted
     """
@@ -74,21 +74,26 @@ def get_frames_interval(video_path, frame_interval):
     success, image = cap.read()
     count = 0
 
-    image_arr = []
     while success and count < length:
         success, image = cap.read()
         if count % frame_interval == 0:
-            image = _get_image_from_array(image)
-            image_arr.append(image)
+            yield _get_image_from_array(image)
 
         count += 1
 
-    return image_arr
 
+def get_frames_interval(video_path, frame_interval):
+    """
+    Selects one frames after every frame_interval
+    @param video_path: Path to video file on system
+    @param frame_interval: Interval after which frame should be picked. If frame_interval=10 then every 10th frame will be extracted
+    """
+    return list(iter_frames_interval(video_path, frame_interval))
 
-def get_n_frames(video_path, num_frame):
+
+def iter_n_frames(video_path, num_frame):
     """
-    Get N frames equidistant to each other in a video
+    Yields N frames equidistant to each other in a video, as the video is being decoded
     @param video_path: Path to video file on system
     @param num_frame: Number of frames to be extracted from video. If num_frame=10 then 10 frames equally distant from each other will be extracted
     """
@@ -101,13 +106,18 @@ def get_n_frames(video_path, num_frame):
     success, image = cap.read()
     count = 0
 
-    image_arr = []
     while success and count < length:
         success, image = cap.read()
         if success and count in op_frame_idx:
-            image = _get_image_from_array(image)
-            image_arr.append(image)
+            yield _get_image_from_array(image)
 
         count += 1
 
-    return image_arr
+
+def get_n_frames(video_path, num_frame):
+    """
+    Get N frames equidistant to each other in a video
+    @param video_path: Path to video file on system
+    @param num_frame: Number of frames to be extracted from video. If num_frame=10 then 10 frames equally distant from each other will be extracted
+    """
+    return list(iter_n_frames(video_path, num_frame))